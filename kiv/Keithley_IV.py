@@ -1,13 +1,112 @@
+import os
 import sys
+import asyncio
+import matplotlib
+if os.environ.get('KIV_BATCH'):
+    matplotlib.use('Agg', force=True)
 import matplotlib.pyplot as plt
 from matplotlib.lines import Line2D
-import matplotlib
 import numpy as np
 from scipy import stats
 import pyvisa as visa
-import time
+import warnings
 import pint
 
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+
+_RM = None
+
+
+def _get_rm():
+    """ Returns a module-wide VISA ResourceManager, created on first use """
+    global _RM
+    if _RM is None:
+        _RM = visa.ResourceManager()
+    return _RM
+
+
+def _linregress(x, y):
+    """ Least squares fit of y against x from mean-centred sums. Returns
+    slope, intercept, correlation coefficient r and standard error of the slope """
+    n = x.size
+    mx = x.mean()
+    my = y.mean()
+    xd = x - mx
+    yd = y - my
+    sxx = np.dot(xd, xd)
+    syy = np.dot(yd, yd)
+    sxy = np.dot(xd, yd)
+    slope = sxy / sxx
+    intercept = my - slope*mx
+    r = min(max(sxy / np.sqrt(sxx*syy), -1.0), 1.0)
+    if n > 2:
+        std_error = np.sqrt((1 - r**2) * syy / sxx / (n - 2))
+    else:
+        std_error = 0.0
+    return slope, intercept, r, std_error
+
+
+if njit is not None:
+    _linregress = njit(cache=True, error_model='numpy')(_linregress)
+
+
+def _fit_line(x, y):
+    """ Fits y against x, returning slope, intercept, r, p and std_error in the
+    order of scipy.stats.linregress """
+    slope, intercept, r, std_error = map(np.float64, _linregress(x, y))
+    df = x.size - 2
+    if df <= 0:
+        # Two points always lie on the line; linregress reports p = 0 here
+        return slope, intercept, r, np.float64(0.0), std_error
+    t = r*np.sqrt(df / ((1 - r + 1e-20)*(1 + r + 1e-20)))
+    p = 2*stats.t.sf(abs(t), df)
+    return slope, intercept, r, p, std_error
+
+
+def _batch_linregress(X, Y):
+    """ Fits M sweeps at once. X and Y are (M, N) arrays of M sweeps with
+    N points each; returns arrays of the M slopes and intercepts """
+    X = np.atleast_2d(X)
+    Y = np.atleast_2d(Y)
+    mx = X.mean(axis=1)
+    my = Y.mean(axis=1)
+    xd = X - mx[:, None]
+    yd = Y - my[:, None]
+    slope = np.einsum('ij,ij->i', xd, yd) / np.einsum('ij,ij->i', xd, xd)
+    intercept = my - slope*mx
+    return slope, intercept
+
+
+class _ScpiQueue(object):
+    """ Collects SCPI commands keyed by their header so that only the most
+    recent setting of each is sent. flush() writes everything pending as a
+    single semicolon-chained message """
+    def __init__(self, resource):
+        self.resource = resource
+        self.pending = {}
+
+
+    def write(self, message):
+        """ Queues each command of a (possibly chained) message """
+        for command in message.split(';'):
+            command = command.strip()
+            if not command:
+                continue
+            if not command.startswith((':', '*')):
+                command = ':' + command
+            self.pending[command.split(' ', 1)[0].upper()] = command
+
+
+    def flush(self):
+        """ Sends all pending commands to the instrument """
+        if self.pending:
+            self.resource.write(";".join(self.pending.values()))
+            self.pending.clear()
+
 
 class Keithley6487_IV(object):
     """
@@ -38,7 +137,11 @@ class Keithley6487_IV(object):
         self.stepsize = stepsize
         self.delay = delay
         self.nplc = nplc
-        self.nsteps = int(abs((stop - start) / stepsize) + 1)
+        step = np.copysign(stepsize, stop - start)
+        self.vgrid = np.arange(start, stop + step/2, step)
+        self.nsteps = self.vgrid.size
+        self.data_out = 'READ,VSO'
+        self.data_count = self.data_out.count(',') + 1
 
         self.connect_keithley(ID)
         self.timeout()
@@ -51,9 +154,15 @@ class Keithley6487_IV(object):
 
     def connect_keithley(self, ID):
         """ Starts Connection to Keithley Meter """
-        rm = visa.ResourceManager()
+        rm = _get_rm()
         self.keithley = rm.open_resource(ID)
+        self.keithley.write_termination = '\n'
+        self.keithley.read_termination = '\n'
+        self.keithley.send_end = True
+        expected = self.nsteps * self.data_count * 4 + 128
+        self.keithley.chunk_size = max(20480, expected)
         self.keithley.write("*RST")
+        self.queue = _ScpiQueue(self.keithley)
 
 
     def timeout(self):
@@ -63,34 +172,35 @@ class Keithley6487_IV(object):
 
     def program_sens(self):
         """ Setting parameters in SENSor SCPI commands """
-        self.keithley.write(":SENS:FUNC 'CURR:DC' ")
-        self.keithley.write(":SENS:CURR:RANG:AUTO ON")
-        self.keithley.write(":SENS:CURR:NPLC ", str(self.nplc))
+        self.queue.write(";".join([":SENS:FUNC 'CURR:DC'",
+                                   ":SENS:CURR:RANG:AUTO ON",
+                                   f":SENS:CURR:NPLC {self.nplc}"]))
 
 
     def program_sour(self):
         """ Setting parameters in SOURce SCPI commands """
-        self.keithley.write(":SOUR:VOLT:SWE:STAR ", str(self.start))
-        self.keithley.write(":SOUR:VOLT:SWE:STOP ", str(self.stop))
-        self.keithley.write(":SOUR:VOLT:SWE:STEP ", str(self.stepsize))
-        self.keithley.write(":SOUR:VOLT:SWE:DEL ", str(self.delay))
+        self.queue.write(";".join([f":SOUR:VOLT:SWE:STAR {self.start}",
+                                   f":SOUR:VOLT:SWE:STOP {self.stop}",
+                                   f":SOUR:VOLT:SWE:STEP {self.stepsize}",
+                                   f":SOUR:VOLT:SWE:DEL {self.delay}"]))
 
 
     def program_form(self):
         """ Setting parameters in FORMat SCPI commands """
-        self.keithley.write(":FORM:DATA ASC")
-        self.keithley.write(":FORM:ELEM READ,VSO")
+        self.queue.write(";".join([":FORM:DATA REAL,32",
+                                   ":FORM:BORD SWAP",
+                                   f":FORM:ELEM {self.data_out}"]))
 
 
     def program_trig(self):
         """ Setting parameters in TRIGger SCPI commands """
-        self.keithley.write(":TRIG:SOUR IMM")
-        self.keithley.write(":TRIG:COUN ", str(self.nsteps))
+        self.queue.write(";".join([":TRIG:SOUR IMM",
+                                   f":TRIG:COUN {self.nsteps}"]))
 
 
     def program_syst(self):
         """ Setting parameters in SYSTem SCPI commands """
-        self.keithley.write("SYST:ZCH OFF")
+        self.queue.write(":SYST:ZCH OFF;:DISP:ENAB OFF")
 
 
     @property
@@ -105,19 +215,47 @@ class Keithley6487_IV(object):
         vso: The voltage source list
         curr: Current list in ohms
         """
+        self.queue.flush()
         self.keithley.write(":SOUR:VOLT:SWE:INIT")
-        self.result = self.keithley.query(":READ?")
-        self.yvalues = np.array(self.keithley.query_ascii_values(":FETC?"))
-        self.curr = np.array(self.yvalues[0::2])
-        self.vso = np.array(self.yvalues[1::2])
+        self.keithley.write(":INIT")
+        self.keithley.query("*OPC?")
+        self.yvalues = self.keithley.query_binary_values(":FETC?", datatype='f', is_big_endian=False,
+                                                         container=np.ndarray,
+                                                         data_points=self.nsteps*self.data_count)
+        buf = self.yvalues.reshape(-1, self.data_count)
+        self.curr = np.ascontiguousarray(buf[:, 0], dtype=np.float64)
+        self.vso = np.ascontiguousarray(buf[:, -1], dtype=np.float64)
+        self.check_vgrid()
+
+
+    def check_vgrid(self):
+        """ Warns if the sourced voltages do not match the requested sweep,
+        e.g. when steps were skipped """
+        tol = abs(self.stepsize) / 2
+        if self.vso.size != self.nsteps or not np.allclose(self.vso, self.vgrid, rtol=0, atol=tol):
+            warnings.warn('Sourced voltages do not match the requested sweep of '
+                          f'{self.nsteps} steps from {self.start} to {self.stop} V')
+
+
+    async def begin_runs_async(self):
+        """ Runs begin_runs without blocking the event loop so that sweeps on
+        several instruments can overlap, e.g.
+        await asyncio.gather(k1.begin_runs_async(), k2.begin_runs_async())
+        """
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.begin_runs)
 
 
     def calc_resistance(self):
         """ Calculates resistance (in ohms) from slope of linear fit to IV data """
-        self.slope, self.intercept, self.r, self.p, self.std_error = stats.linregress(self.vso, self.curr)
+        self.slope, self.intercept, self.r, self.p, self.std_error = _fit_line(self.vso, self.curr)
+        self.fit_line = self.slope*self.vso + self.intercept
         self.resistance = (1 / self.slope)
 
 
+    batch_linregress = staticmethod(_batch_linregress)
+
+
     def calc_resistivity(self, length=None, SA=None, U=None, units=None):
         """ Calculates resistivity based on input length and surface area (SA)
         of sample under measurement. Requires units from pint UnitRegistry
@@ -139,33 +277,35 @@ class Keithley6487_IV(object):
         if fit:
             self.calc_resistance()
             legend.append(Line2D([0], [0], color='darkorange', lw=4, label='Fitted Linear Line'))
-            legend.append(Line2D([0], [0], color='white', label='$R^2$: '+str(self.r**2)[:5]))
-            legend.append(Line2D([0], [0], color='white', label='Resistance: '+str(self.resistance)+
-                                  '$\; \Omega$'))
+            legend.append(Line2D([0], [0], color='white', label=f'$R^2$: {self.r**2:.4f}'))
+            legend.append(Line2D([0], [0], color='white',
+                                 label=rf'Resistance: {self.resistance:.3e}$\; \Omega$'))
 
         matplotlib.rcParams.update({'font.size': 12})
-        plt.figure(figsize=(12,8))
-        plt.scatter(self.vso, self.curr, color='navy')
+        fig, ax = plt.subplots(figsize=(12,8))
+        ax.scatter(self.vso, self.curr, color='navy')
         if fit:
-            plt.plot(self.vso, self.slope*self.vso + self.intercept, color='darkorange')
-        plt.xlabel('Voltage (V)')
-        plt.ylabel('Current (A)')
-        plt.title('IV Curve')
-        plt.legend(handles=legend)
-        plt.tight_layout()
+            ax.plot(self.vso, self.fit_line, color='darkorange')
+        ax.set_xlabel('Voltage (V)')
+        ax.set_ylabel('Current (A)')
+        ax.set_title('IV Curve')
+        ax.legend(handles=legend)
+        fig.tight_layout()
         if save:
-            plt.savefig(save)
+            fig.savefig(save)
+            plt.close(fig)
         else:
             plt.show()
 
     def write_csv(self, filename):
         """ Writes data to CSV file """
-        data = np.array((self.vso, self.curr)).transpose()
-        np.savetxt(filename, data, delimiter=',')
+        data = np.column_stack((self.vso, self.curr))
+        np.savetxt(filename, data, delimiter=',', fmt='%.6e')
 
 
     def close_keithley(self):
         """ Call this function to close connection to Keithley 6487  """
+        self.keithley.write(":DISP:ENAB ON")
         self.keithley.close()
 
 
@@ -210,13 +350,14 @@ class Keithley6517B_IV(object):
             self.stepsize = -stepsize
 
         self.delay = delay
-        self.nsteps = int(abs((stop - start) / stepsize) + 1)
+        self.vgrid = np.arange(start, stop + self.stepsize/2, self.stepsize)
+        self.nsteps = self.vgrid.size
         self.nplc = nplc
         if temperature:
             self.data_out = 'READ,VSO,ETEM'
         else:
             self.data_out = 'READ,VSO'
-        self.data_count = self.data_count.count(',') + 1
+        self.data_count = self.data_out.count(',') + 1
 
         self.connect_keithley(ID)
         self.timeout()
@@ -229,9 +370,15 @@ class Keithley6517B_IV(object):
 
     def connect_keithley(self, ID):
         """ Starts Connection to Keithley Meter """
-        rm = visa.ResourceManager()
+        rm = _get_rm()
         self.keithley = rm.open_resource(ID)
+        self.keithley.write_termination = '\n'
+        self.keithley.read_termination = '\n'
+        self.keithley.send_end = True
+        expected = self.nsteps * self.data_count * 8 + 128
+        self.keithley.chunk_size = max(20480, expected)
         self.keithley.write("*RST")
+        self.queue = _ScpiQueue(self.keithley)
 
 
     def timeout(self):
@@ -241,37 +388,38 @@ class Keithley6517B_IV(object):
 
     def program_sens(self):
         """ Setting parameters in SENSor SCPI commands """
-        self.keithley.write(":SENS:FUNC 'CURR:DC' ")
-        self.keithley.write(":SENS:CURR:RANG:AUTO ON")
-        self.keithley.write(":SENS:CURR:NPLC ", str(self.nplc))
+        self.queue.write(";".join([":SENS:FUNC 'CURR:DC'",
+                                   ":SENS:CURR:RANG:AUTO ON",
+                                   f":SENS:CURR:NPLC {self.nplc}"]))
 
 
     def program_tseq(self):
         """ Setting parameters in SOURce SCPI commands """
-        self.keithley.write(":TSEQ:STSW:STAR ", str(self.start))
-        self.keithley.write(":TSEQ:STSW:STOP ", str(self.stop))
-        self.keithley.write(":TSEQ:STSW:STEP ", str(self.stepsize))
-        self.keithley.write(":TSEQ:STSW:STIME ", str(self.delay))
-        self.keithley.write(":TSEQ:TYPE STSW")
-        self.keithley.write(":TSEQ:TSO BUS")
+        self.queue.write(";".join([f":TSEQ:STSW:STAR {self.start}",
+                                   f":TSEQ:STSW:STOP {self.stop}",
+                                   f":TSEQ:STSW:STEP {self.stepsize}",
+                                   f":TSEQ:STSW:STIME {self.delay}",
+                                   ":TSEQ:TYPE STSW",
+                                   ":TSEQ:TSO BUS"]))
 
 
     def program_form(self):
         """ Setting parameters in FORMat SCPI commands """
-        self.keithley.write(":FORM:DATA ASC")
-        self.keithley.write(":FORM:ELEM ", self.data_out)
+        self.queue.write(";".join([":FORM:DATA REAL,64",
+                                   ":FORM:BORD SWAP",
+                                   f":FORM:ELEM {self.data_out}"]))
 
 
     def program_trig(self):
         """ Setting parameters in TRIGger SCPI commands """
-        self.keithley.write(":TRIG:COUN ", str(self.nsteps*self.data_count))
+        self.queue.write(f":TRIG:COUN {self.nsteps}")
 
 
     def program_syst(self):
         """ Setting parameters in SYSTem SCPI commands """
-        self.keithley.write("SYST:ZCH OFF")
+        self.queue.write(":SYST:ZCH OFF;:DISP:ENAB OFF")
         if 'ETEM' in self.data_out:
-            self.keithley.write("SYST:TSC ON")
+            self.queue.write(":SYST:TSC ON")
 
 
     @property
@@ -287,25 +435,49 @@ class Keithley6517B_IV(object):
         curr: Current list in ohms
         temperature: list of temperatures at each measurement datapoint
         """
+        self.queue.flush()
         self.keithley.write(":TSEQ:ARM")
         self.keithley.write("*TRG")
-        time.sleep(int(self.runtime)+5)
-        self.yvalues = np.array(self.keithley.query_ascii_values(":TRACE:DATA?"))
+        self.keithley.query("*OPC?")
+        self.yvalues = self.keithley.query_binary_values(":TRACE:DATA?", datatype='d', is_big_endian=False,
+                                                         container=np.ndarray,
+                                                         data_points=self.nsteps*self.data_count)
+        buf = self.yvalues.reshape(-1, self.data_count)
+        self.curr = np.ascontiguousarray(buf[:, 0])
+        self.vso = np.ascontiguousarray(buf[:, -1])
         if 'ETEM' in self.data_out:
-            self.curr = np.array(self.yvalues[0::3])
-            self.temperature = np.array(self.yvalues[1::3])
-            self.vso = np.array(self.yvalues[2::3])
-        else:
-            self.curr = np.array(self.yvalues[0::2])
-            self.vso = np.array(self.yvalues[1::2])
+            self.temperature = np.ascontiguousarray(buf[:, 1])
+        self.check_vgrid()
+
+
+    def check_vgrid(self):
+        """ Warns if the sourced voltages do not match the requested sweep,
+        e.g. when steps were skipped """
+        tol = abs(self.stepsize) / 2
+        if self.vso.size != self.nsteps or not np.allclose(self.vso, self.vgrid, rtol=0, atol=tol):
+            warnings.warn('Sourced voltages do not match the requested sweep of '
+                          f'{self.nsteps} steps from {self.start} to {self.stop} V')
+
+
+    async def begin_runs_async(self):
+        """ Runs begin_runs without blocking the event loop so that sweeps on
+        several instruments can overlap, e.g.
+        await asyncio.gather(k1.begin_runs_async(), k2.begin_runs_async())
+        """
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.begin_runs)
 
 
     def calc_resistance(self):
         """ Calculates resistance (in ohms) from slope of linear fit to IV data """
-        self.slope, self.intercept, self.r, self.p, self.std_error = stats.linregress(self.vso, self.curr)
+        self.slope, self.intercept, self.r, self.p, self.std_error = _fit_line(self.vso, self.curr)
+        self.fit_line = self.slope*self.vso + self.intercept
         self.resistance = (1 / self.slope)
 
 
+    batch_linregress = staticmethod(_batch_linregress)
+
+
     def calc_resistivity(self, length=None, SA=None, U=None, units=None):
         """ Calculates resistivity based on input length and surface area (SA)
         of sample under measurement. Requires units from pint UnitRegistry
@@ -327,22 +499,23 @@ class Keithley6517B_IV(object):
         if fit:
             self.calc_resistance()
             legend.append(Line2D([0], [0], color='darkorange', lw=4, label='Fitted Linear Line'))
-            legend.append(Line2D([0], [0], color='white', label='$R^2$: '+str(self.r**2)[:5]))
-            legend.append(Line2D([0], [0], color='white', label='Resistance: '+str(self.resistance)+
-                                  '$\; \Omega$'))
+            legend.append(Line2D([0], [0], color='white', label=f'$R^2$: {self.r**2:.4f}'))
+            legend.append(Line2D([0], [0], color='white',
+                                 label=rf'Resistance: {self.resistance:.3e}$\; \Omega$'))
 
         matplotlib.rcParams.update({'font.size': 12})
-        plt.figure(figsize=(12,8))
-        plt.scatter(self.vso, self.curr, color='navy')
+        fig, ax = plt.subplots(figsize=(12,8))
+        ax.scatter(self.vso, self.curr, color='navy')
         if fit:
-            plt.plot(self.vso, self.slope*self.vso + self.intercept, color='darkorange')
-        plt.xlabel('Voltage (V)')
-        plt.ylabel('Current (A)')
-        plt.title('IV Curve')
-        plt.legend(handles=legend)
-        plt.tight_layout()
+            ax.plot(self.vso, self.fit_line, color='darkorange')
+        ax.set_xlabel('Voltage (V)')
+        ax.set_ylabel('Current (A)')
+        ax.set_title('IV Curve')
+        ax.legend(handles=legend)
+        fig.tight_layout()
         if save:
-            plt.savefig(save)
+            fig.savefig(save)
+            plt.close(fig)
         else:
             plt.show()
 
@@ -350,12 +523,12 @@ class Keithley6517B_IV(object):
     def write_csv(self, filename):
         """ Writes data to CSV file """
         if 'ETEM' in self.data_out:
-            data = np.array((self.vso, self.curr, self.temperature)).transpose()
-            np.savetxt(filename, data, delimiter=',')
+            data = np.column_stack((self.vso, self.curr, self.temperature))
         else:
-            data = np.array((self.vso, self.curr)).transpose()
-            np.savetxt(filename, data, delimiter=',')
+            data = np.column_stack((self.vso, self.curr))
+        np.savetxt(filename, data, delimiter=',', fmt='%.6e')
 
     def close_keithley(self):
         """ Call this function to close connection to Keithley 6487 """
+        self.keithley.write(":DISP:ENAB ON")
         self.keithley.close()
@@ -1,9 +1,31 @@
-import matplotlib.pyplot as plt
-from matplotlib import cm
 import matplotlib
+import matplotlib.pyplot as plt
 import numpy as np
-import pyvisa as visa
 import time
+import asyncio
+from kiv.Keithley_IV import _get_rm, _ScpiQueue
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+
+if njit is not None:
+    @njit(cache=True, error_model='numpy')
+    def _normalize(c):
+        """ Scales each row of c onto [0, 1] """
+        out = np.empty_like(c)
+        for i in range(c.shape[0]):
+            mn = c[i].min()
+            rng = c[i].max() - mn
+            for j in range(c.shape[1]):
+                out[i, j] = (c[i, j] - mn) / rng
+        return out
+else:
+    def _normalize(c):
+        """ Scales each row of c onto [0, 1] """
+        return (c - c.min(axis=1, keepdims=True)) / np.ptp(c, axis=1, keepdims=True)
 
 
 class Keithley6487_CVT(object):
@@ -29,89 +51,113 @@ class Keithley6487_CVT(object):
         self.volts = np.array(volts)
         self.nplc = nplc
         self.delay = 2
-        self.times = {}
-        self.curr = {}
+        self.times = np.empty((len(self.volts), self.nval), dtype=np.float64)
+        self.curr = np.empty((len(self.volts), self.nval), dtype=np.float64)
+
+        self.connect_keithley(ID)
 
 
-    def setup_run(self, v):
+    def connect_keithley(self, ID):
+        """ Starts Connection to Keithley Meter """
+        rm = _get_rm()
+        self.keithley = rm.open_resource(ID)
+        self.keithley.write_termination = '\n'
+        self.keithley.read_termination = '\n'
+        self.keithley.send_end = True
+        expected = self.nval * 2 * 4 + 128
+        self.keithley.chunk_size = max(20480, expected)
+        self.queue = _ScpiQueue(self.keithley)
+
+
+    def setup_run(self):
         """ Sends all appropriate commands to Keithley 6487 to set system
         up to begin the runs
         """
-        rm = visa.ResourceManager()
-        self.keithley = rm.open_resource('GPIB0::22::INSTR')
         self.keithley.write("*RST")
         self.keithley.timeout = 50000
-        self.keithley.write(":SYST:ZCH OFF")
-        self.keithley.write(":SENS:FUNC 'CURR:DC'")
-        self.keithley.write(":SENS:CURR:RANG:AUTO ON")
-        self.keithley.write(":SENS:CURR:NPLC ", str(self.nplc))
-        self.keithley.write(":FORM:DATA ASC")
-        self.keithley.write(":FORM:ELEM READ,TIME")
-        self.keithley.write(":TRIG:SOUR IMM")
-        self.keithley.write(":TRIG:COUN ", str(self.nval))
-        self.keithley.write(":SOUR:VOLT ", str(v))
+        self.queue.write(";".join([":SYST:ZCH OFF",
+                                   ":DISP:ENAB OFF",
+                                   ":SENS:FUNC 'CURR:DC'",
+                                   ":SENS:CURR:RANG:AUTO ON",
+                                   f":SENS:CURR:NPLC {self.nplc}",
+                                   ":FORM:DATA REAL,32",
+                                   ":FORM:BORD SWAP",
+                                   ":FORM:ELEM READ,TIME",
+                                   ":TRIG:SOUR IMM",
+                                   f":TRIG:COUN {self.nval}"]))
 
 
     def begin_runs(self):
         """ Call this function to begin the runs across the entire voltage range
         given by volts
         """
-        for i in volts:
-            self.setup_run(i)
-            self.keithley.write(":SOUR:VOLT:STAT ON")
-            result = keithley.query(":READ?")
-            self.yvalues = np.array(keithley.query_ascii_values(":FETC?"))
+        self.setup_run()
+        self.queue.flush()
+        for i, volt in enumerate(self.volts):
+            self.keithley.write(f":SOUR:VOLT {volt};:SOUR:VOLT:STAT ON")
+            self.keithley.write(":INIT")
+            self.keithley.query("*OPC?")
+            self.yvalues = self.keithley.query_binary_values(":FETC?", datatype='f', is_big_endian=False,
+                                                             container=np.ndarray,
+                                                             data_points=2*self.nval)
             self.keithley.write(":SOUR:VOLT:STAT OFF")
-            self.times[i] = np.array(self.yvalues[1::2]) - self.yvalues[1]
-            self.curr[i] = np.array(self.yvalues[0::2])
+            buf = self.yvalues.reshape(-1, 2)
+            self.curr[i] = buf[:, 0]
+            self.times[i] = buf[:, 1] - buf[0, 1]
             time.sleep(self.delay)
 
 
+    async def begin_runs_async(self):
+        """ Runs begin_runs without blocking the event loop so that sweeps on
+        several instruments can overlap, e.g.
+        await asyncio.gather(k1.begin_runs_async(), k2.begin_runs_async())
+        """
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.begin_runs)
+
+
     def plot(self, normalize=True, save=False, size=10, colormap='viridis'):
         """ Plots the data either normalized or raw
         Normalized data is preferred if finding time to steady-state current
         for example when determining appropriate delay time in IV measurement
         """
         if normalize:
-            self.normalized = {}
-            for volt in self.volts
-                if volts < 0:
-                    self.normalized[volt] = -((self.curr[volt] - np.min(self.curr[volt]))/np.ptp(self.curr[volt])) + 1
-                else:
-                    self.normalized[volt] = (self.curr[volt] - np.min(self.curr[volt]))/np.ptp(self.curr[volt])
-
-        clist = (volts - np.min(volts))/np.ptp(volts)
-        cmap = cm.get_cmap(colormap)
+            N = _normalize(self.curr)
+            self.normalized = np.where((self.volts < 0)[:, None], 1 - N, N)
+
+        clist = (self.volts - np.min(self.volts))/np.ptp(self.volts)
+        cmap = plt.get_cmap(colormap)
         matplotlib.rcParams.update({'font.size': 14})
-        plt.figure(figsize=(12,8))
+        fig, ax = plt.subplots(figsize=(12,8))
+        for index, volt in enumerate(self.volts):
+            if normalize:
+                y = self.normalized[index]
+            else:
+                y = self.curr[index]
+            ax.plot(self.times[index], y, label=str(volt), marker='o', lw=0,
+                    color=cmap(clist[index]), markersize=size)
         if normalize:
-            index = 0
-            for volt in self.volts:
-                plt.plot(self.times[volt], self.normalized[volt], label=str(volt), marker='o', lw=0,
-                        color=cmap(clist[index]), s=size)
-                plt.ylabel('Normalized Current [A]')
-                index += 1
+            ax.set_ylabel('Normalized Current [A]')
         else:
-            index = 0
-            for volt in self.volts:
-                plt.plot(self.times[volt], self.curr[volt], label=str(volt), marker='o', lw=0,
-                        color=cmap(clist[index]), s=size)
-                plt.ylabel('Current [A]')
-                index += 1
-        plt.xlabel('Time [s]')
-        plt.legend()
-        plt.tight_layout()
+            ax.set_ylabel('Current [A]')
+        ax.set_xlabel('Time [s]')
+        ax.legend()
+        fig.tight_layout()
         if save:
-            plt.savefig(save)
+            fig.savefig(save)
+            plt.close(fig)
         else:
             plt.show()
 
 
     def write_csv(self, filename, volt):
         """ Writes data to a csv """
-        np.savetxt(filename, np.transpose((self.times[volt], self.curr[volt]), delimiter=','))
+        i = np.flatnonzero(self.volts == volt)[0]
+        data = np.column_stack((self.times[i], self.curr[i]))
+        np.savetxt(filename, data, delimiter=',', fmt='%.6e')
 
 
     def close_keithley(self):
         """ Call this function to close connection to Keithley 6487  """
+        self.keithley.write(":DISP:ENAB ON")
         self.keithley.close()
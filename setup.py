@@ -26,6 +26,10 @@ REQUIRED = ['pint',
             'pyvisa',
 ]
 
+EXTRAS = {
+    'jit': ['numba'],
+}
+
 
 try:
     with io.open(os.path.join(cwd, 'README.md'), encoding='utf-8') as f:
@@ -86,6 +90,7 @@ setup(
     packages=find_packages(exclude=('tests',)),
 
     install_requires=REQUIRED,
+    extras_require=EXTRAS,
 
     license='MIT',
     classifiers=[